@@ -1,41 +1,100 @@
+import time
+import aiohttp
+from aiohttp.hdrs import USER_AGENT
 from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import EVENT_HOMEASSISTANT_CLOSE
 from homeassistant.core import HomeAssistant
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
-from .const import DOMAIN, DEFAULT_SCAN_INTERVAL
-from .coordinator import MarstekAPI, MarstekCoordinator
+from homeassistant.helpers.aiohttp_client import SERVER_SOFTWARE
+from homeassistant.util.ssl import client_context
+from .const import DOMAIN, DEFAULT_SCAN_INTERVAL, SESSION, SESSION_CLOSE_LISTENER
+from .coordinator import MarstekAPI, MarstekCoordinator, REQUEST_TIMEOUT
 
 PLATFORMS: list[str] = ["sensor"]
 
+def _get_session(hass: HomeAssistant) -> aiohttp.ClientSession:
+    """Return the integration-wide session, creating it on first use."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    session = domain_data.get(SESSION)
+    if session is None or session.closed:
+        # Keep-alive connections and DNS caching to the single Marstek host,
+        # with Home Assistant's SSL context and user agent
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=4,
+                limit_per_host=2,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+                ssl=client_context(),
+            ),
+            headers={USER_AGENT: SERVER_SOFTWARE},
+            timeout=REQUEST_TIMEOUT,
+        )
+        domain_data[SESSION] = session
+
+        # Entries are not unloaded on shutdown, so close the session there too
+        async def _close_session(event):
+            await session.close()
+
+        domain_data[SESSION_CLOSE_LISTENER] = hass.bus.async_listen_once(
+            EVENT_HOMEASSISTANT_CLOSE, _close_session
+        )
+    return session
+
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Set up Marstek from a config entry."""
     # Pre-import platforms to avoid blocking import inside event loop
     for platform in PLATFORMS:
         __import__(f"{__package__}.{platform}")
 
-    session = async_get_clientsession(hass)
-    api = MarstekAPI(session, entry.data["email"], entry.data["password"])
+    session = _get_session(hass)
+
+    def _store_token(token):
+        """Persist the token so it survives restarts."""
+        hass.config_entries.async_update_entry(
+            entry, data={**entry.data, "token": token, "token_ts": time.time()}
+        )
+
+    api = MarstekAPI(
+        session,
+        entry.data["email"],
+        entry.data["password"],
+        token=entry.data.get("token"),
+        token_ts=entry.data.get("token_ts"),
+        on_token=_store_token,
+    )
 
     scan_interval = entry.options.get(
         "scan_interval",
         entry.data.get("scan_interval", DEFAULT_SCAN_INTERVAL)
     )
 
-    coordinator = MarstekCoordinator(hass, api, scan_interval)
+    coordinator = MarstekCoordinator(hass, api, scan_interval, entry)
     await coordinator.async_config_entry_first_refresh()
 
-    hass.data.setdefault(DOMAIN, {})
     hass.data[DOMAIN][entry.entry_id] = coordinator
 
     # Ensure devices key exists in config_entry.data
-    devices = coordinator.data or []
-    hass.config_entries.async_update_entry(entry, data={**entry.data, "devices": devices})
+    hass.config_entries.async_update_entry(entry, data={**entry.data, "devices": coordinator.stored_devices()})
+    entry.async_on_unload(entry.add_update_listener(_async_update_listener))
 
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
     return True
 
+async def _async_update_listener(hass: HomeAssistant, entry: ConfigEntry):
+    """Apply changed options without reloading the entry."""
+    hass.data[DOMAIN][entry.entry_id].update_from_entry(entry)
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Unload a config entry."""
     unload_ok = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
     if unload_ok:
         hass.data[DOMAIN].pop(entry.entry_id)
+        # Close the shared session once the last entry is gone
+        if not any(key not in (SESSION, SESSION_CLOSE_LISTENER) for key in hass.data[DOMAIN]):
+            remove_close_listener = hass.data[DOMAIN].pop(SESSION_CLOSE_LISTENER, None)
+            if remove_close_listener is not None:
+                remove_close_listener()
+            session = hass.data[DOMAIN].pop(SESSION, None)
+            if session is not None:
+                await session.close()
     return unload_ok
@@ -1,7 +1,17 @@
+import asyncio
+from functools import lru_cache
+import time
+import aiohttp
 import voluptuous as vol
 from homeassistant import config_entries
 from homeassistant.core import callback
-from .const import DOMAIN, DEFAULT_SCAN_INTERVAL, DEFAULT_CAPACITY_KWH
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.update_coordinator import UpdateFailed
+from .const import DOMAIN, DEFAULT_SCAN_INTERVAL, DEFAULT_CAPACITY_KWH, SESSION
+from .coordinator import MarstekAPI, MarstekAuthError
+
+_SCAN_INTERVAL_VALIDATOR = vol.All(vol.Coerce(int), vol.Range(min=10, max=3600))
+_CAPACITY_VALIDATOR = vol.All(vol.Coerce(float), vol.Range(min=0.1, max=100))
 
 DATA_SCHEMA = vol.Schema({
     vol.Required("email"): str,
@@ -9,27 +19,67 @@ DATA_SCHEMA = vol.Schema({
     vol.Required(
         "scan_interval",
         default=DEFAULT_SCAN_INTERVAL
-    ): vol.All(vol.Coerce(int), vol.Range(min=10, max=3600)),
-    vol.Optional("default_capacity_kwh", default=5.12): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=100))  # Rename capacity_kwh to default_capacity_kwh
+    ): _SCAN_INTERVAL_VALIDATOR,
+    vol.Optional("default_capacity_kwh", default=5.12): _CAPACITY_VALIDATOR  # Rename capacity_kwh to default_capacity_kwh
+})
+
+SCAN_INTERVAL_ONLY_SCHEMA = vol.Schema({
+    vol.Optional("scan_interval", default=DEFAULT_SCAN_INTERVAL): _SCAN_INTERVAL_VALIDATOR
 })
 
+@lru_cache(maxsize=8)
+def _options_schema(scan_interval, default_capacity_kwh, devices):
+    """Build the options schema; devices is a tuple of (devid, name, capacity_kwh)."""
+    # Generate a schema for editing capacity_kwh for each battery with descriptions
+    data_schema = {
+        vol.Optional("scan_interval", default=scan_interval): _SCAN_INTERVAL_VALIDATOR
+    }
+    for devid, name, capacity_kwh in devices:
+        description = f"Set the capacity (in kWh) for {name}"  # Add description for each option
+        data_schema[vol.Optional(
+            f"{devid}_capacity_kwh",
+            default=capacity_kwh,
+            description={"suggested_value": default_capacity_kwh, "description": description}
+        )] = _CAPACITY_VALIDATOR
+    return vol.Schema(data_schema)
+
 class MarstekConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     VERSION = 1
 
+    async def _test_connection(self, email, password):
+        """Log in once to validate the credentials."""
+        # Reuse the integration's shared session if another entry created it
+        session = self.hass.data.get(DOMAIN, {}).get(SESSION)
+        if session is None or session.closed:
+            session = async_get_clientsession(self.hass)
+        api = MarstekAPI(session, email, password)
+        return await api.async_login()
+
     async def async_step_user(self, user_input=None):
+        errors = {}
         if user_input is not None:
-            return self.async_create_entry(
-                title="Marstek Cloud",
-                data={
-                    "email": user_input["email"],
-                    "password": user_input["password"],
-                    "scan_interval": user_input["scan_interval"],
-                    "default_capacity_kwh": user_input.get("default_capacity_kwh", 5.12)  # Default capacity in kwh for all devices
-                }
-            )
+            try:
+                token = await self._test_connection(user_input["email"], user_input["password"])
+            except MarstekAuthError:
+                errors["base"] = "invalid_auth"
+            except (UpdateFailed, aiohttp.ClientError, asyncio.TimeoutError):
+                errors["base"] = "cannot_connect"
+            else:
+                return self.async_create_entry(
+                    title="Marstek Cloud",
+                    data={
+                        "email": user_input["email"],
+                        "password": user_input["password"],
+                        "scan_interval": user_input["scan_interval"],
+                        "default_capacity_kwh": user_input.get("default_capacity_kwh", 5.12),  # Default capacity in kwh for all devices
+                        "token": token,  # Reused by the first update instead of logging in again
+                        "token_ts": time.time(),
+                    }
+                )
         return self.async_show_form(
             step_id="user",
-            data_schema=DATA_SCHEMA
+            data_schema=DATA_SCHEMA,
+            errors=errors
         )
 
     @staticmethod
@@ -49,22 +99,30 @@ class MarstekOptionsFlow(config_entries.OptionsFlow):
         if user_input is not None:
             return self.async_create_entry(title="", data=user_input)
 
-        # Generate a schema for editing capacity_kwh for each battery with descriptions
         options = self._config_entry.options
-        data_schema = {}
+        scan_interval = options.get(
+            "scan_interval",
+            self._config_entry.data.get("scan_interval", DEFAULT_SCAN_INTERVAL)
+        )
         # Handle missing devices key gracefully
         devices = self._config_entry.data.get("devices", [])
-        if not devices:
-            return self.async_abort(reason="no_devices_found")
+        if not devices and scan_interval == DEFAULT_SCAN_INTERVAL:
+            # Nothing entry-specific to show, so the shared schema will do
+            schema = SCAN_INTERVAL_ONLY_SCHEMA
+        else:
+            schema = self._get_schema(devices, options, scan_interval)
 
-        for device in devices:
-            devid = device["devid"]
-            name = device["name"]
-            description = f"Set the capacity (in kWh) for {name}"  # Add description for each option
-            data_schema[vol.Optional(
-                f"{devid}_capacity_kwh",
-                default=options.get(f"{devid}_capacity_kwh", DEFAULT_CAPACITY_KWH),
-                description={"suggested_value": DEFAULT_CAPACITY_KWH, "description": description}
-            )] = vol.Coerce(float)
+        return self.async_show_form(step_id="init", data_schema=schema)
 
-        return self.async_show_form(step_id="init", data_schema=vol.Schema(data_schema))
+    def _get_schema(self, devices, options, scan_interval):
+        """Return the compiled options schema, cached on the values it is built from."""
+        # Match the coordinator's fallback so submitting the form keeps the setup default
+        default_capacity_kwh = self._config_entry.data.get("default_capacity_kwh", DEFAULT_CAPACITY_KWH)
+        return _options_schema(scan_interval, default_capacity_kwh, tuple(
+            (
+                device["devid"],
+                device["name"],
+                options.get(f"{device['devid']}_capacity_kwh", default_capacity_kwh),
+            )
+            for device in devices
+        ))
@@ -3,3 +3,5 @@ API_LOGIN = "https://eu.hamedata.com/app/Solar/v2_get_device.php"
 API_DEVICES = "https://eu.hamedata.com/ems/api/v1/getDeviceList"
 DEFAULT_SCAN_INTERVAL = 60  # seconds
 DEFAULT_CAPACITY_KWH = 5.12
+SESSION = "session"  # hass.data[DOMAIN] key for the shared aiohttp session
+SESSION_CLOSE_LISTENER = "session_close_listener"  # hass.data[DOMAIN] key for its shutdown hook
@@ -1,68 +1,121 @@
 import hashlib
 import aiohttp
-import async_timeout
 import time
 import logging
 from datetime import timedelta
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
-from .const import API_LOGIN, API_DEVICES
+from homeassistant.util import dt as dt_util
+from .const import API_LOGIN, API_DEVICES, DEFAULT_CAPACITY_KWH
+
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=5)
+TOKEN_TTL = 3600  # seconds before a token is refreshed proactively
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
 
 _LOGGER = logging.getLogger(__name__)
 
+class MarstekAuthError(UpdateFailed):
+    """The API rejected the login credentials."""
+
 class MarstekAPI:
-    def __init__(self, session: aiohttp.ClientSession, email: str, password: str):
+    def __init__(self, session: aiohttp.ClientSession, email: str, password: str, token: str | None = None, token_ts: float | None = None, on_token=None):
         self._session = session
         self._email = email
-        self._password = password
+        self._md5_pwd = hashlib.md5(password.encode("utf-8")).hexdigest()
+        self._token = token  # May be preseeded from a previous run
+        self._token_expires_at = 0.0  # time.monotonic() deadline for trusting the token
+        if token and token_ts is not None:
+            # token_ts is wall-clock (it survives restarts); convert its remaining TTL to monotonic
+            self._token_expires_at = time.monotonic() + TOKEN_TTL - (time.time() - token_ts)
+        self._on_token = on_token  # Called with each newly obtained token
+
+    def _clear_token(self):
         self._token = None
+        self._token_expires_at = 0.0
+
+    async def _request(self, method: str, url: str, params: dict) -> dict:
+        """Perform a request and return the decoded JSON body."""
+        # Also passed per request so sessions without it (config flow fallback) are bounded
+        async with self._session.request(method, url, params=params, timeout=REQUEST_TIMEOUT) as resp:
+            resp.raise_for_status()
+            body = await resp.read()
+        try:
+            data = _loads(body)
+        except ValueError as err:
+            raise UpdateFailed(f"Invalid response from Marstek API: {body[:200]!r}") from err
+        if not isinstance(data, dict):
+            raise UpdateFailed(f"Unexpected response from Marstek API: {data!r}")
+        return data
+
+    async def _fetch_devices(self) -> dict:
+        """Request the device list, reporting HTTP 401/403 like the API's token error codes."""
+        try:
+            return await self._request("GET", API_DEVICES, {"token": self._token})
+        except aiohttp.ClientResponseError as err:
+            if err.status not in (401, 403):
+                raise
+            return {"code": err.status}
 
     async def _get_token(self):
-        md5_pwd = hashlib.md5(self._password.encode()).hexdigest()
-        params = {"pwd": md5_pwd, "mailbox": self._email}
-        async with async_timeout.timeout(10):
-            async with self._session.post(API_LOGIN, params=params) as resp:
-                data = await resp.json()
-                if "token" not in data:
-                    raise UpdateFailed(f"Login failed: {data}")
-                self._token = data["token"]
-                _LOGGER.info("Marstek: Obtained new API token")
+        params = {"pwd": self._md5_pwd, "mailbox": self._email}
+        try:
+            data = await self._request("POST", API_LOGIN, params)
+        except aiohttp.ClientResponseError as err:
+            if err.status not in (401, 403):
+                raise
+            raise MarstekAuthError(f"Login failed: HTTP {err.status}") from err
+        if "token" not in data:
+            raise MarstekAuthError(f"Login failed: {data}")
+        self._token = data["token"]
+        self._token_expires_at = time.monotonic() + TOKEN_TTL
+        _LOGGER.info("Marstek: Obtained new API token")
+        if self._on_token is not None:
+            self._on_token(self._token)
+
+    async def async_login(self) -> str:
+        """Log in and return the new API token."""
+        await self._get_token()
+        return self._token
 
     async def get_devices(self):
-        if not self._token:
+        # Log in again up front rather than spend a request on a token past its TTL
+        if not self._token or time.monotonic() >= self._token_expires_at:
+            await self._get_token()
+
+        data = await self._fetch_devices()
+
+        # Debug: Log the full API response
+        _LOGGER.debug("Marstek API full response: %s", data)
+
+        # Handle token expiration or invalid token (the API sends codes as int or str)
+        code = data.get("code")
+        if code in (-1, 401, 403, "-1", "401", "403"):
+            _LOGGER.warning("Marstek: Token expired or invalid, refreshing...")
+            self._clear_token()
             await self._get_token()
+            data = await self._fetch_devices()
 
-        params = {"token": self._token}
-        async with async_timeout.timeout(10):
-            async with self._session.get(API_DEVICES, params=params) as resp:
-                data = await resp.json()
-                
-                # Debug: Log the full API response
-                _LOGGER.debug("Marstek API full response: %s", data)
-
-                # Handle token expiration or invalid token
-                if str(data.get("code")) in ("-1", "401", "403") or "token" in str(data).lower():
-                    _LOGGER.warning("Marstek: Token expired or invalid, refreshing...")
-                    await self._get_token()
-                    params["token"] = self._token
-                    async with self._session.get(API_DEVICES, params=params) as retry_resp:
-                        data = await retry_resp.json()
-                        
-                        # Debug: Log the full API response after retry
-                        _LOGGER.debug("Marstek API full response (after retry): %s", data)
-
-                # Handle specific error code 8 (no access permission)
-                if str(data.get("code")) == "8":
-                    _LOGGER.error("Marstek: No access permission (code 8). Clearing token and will retry on next update.")
-                    self._token = None  # Clear the token so a new one will be obtained on next attempt
-                    raise UpdateFailed(f"Device fetch failed: {data}")
-
-                if "data" not in data:
-                    raise UpdateFailed(f"Device fetch failed: {data}")
-
-                return data["data"]
+            # Debug: Log the full API response after retry
+            _LOGGER.debug("Marstek API full response (after retry): %s", data)
+            code = data.get("code")
+
+        # Handle specific error code 8 (no access permission)
+        if code in (8, "8"):
+            _LOGGER.error("Marstek: No access permission (code 8). Clearing token and will retry on next update.")
+            self._clear_token()  # Clear the token so a new one will be obtained on next attempt
+            raise UpdateFailed(f"Device fetch failed: {data}")
+
+        if "data" not in data:
+            self._clear_token()  # Unrecognised error, log in again on next attempt
+            raise UpdateFailed(f"Device fetch failed: {data}")
+
+        return data["data"]
 
 class MarstekCoordinator(DataUpdateCoordinator):
-    def __init__(self, hass, api: MarstekAPI, scan_interval: int):
+    def __init__(self, hass, api: MarstekAPI, scan_interval: int, entry):
         super().__init__(
             hass,
             logger=_LOGGER,
@@ -71,11 +124,70 @@ class MarstekCoordinator(DataUpdateCoordinator):
         )
         self.api = api
         self.last_latency = None
+        self.devices_by_id = {}  # devid -> device dict, rebuilt on every refresh
+        self.total_charge_kwh = None
+        self.total_power_w = None
+        self.last_update_time = None
+        self.default_capacity_kwh = DEFAULT_CAPACITY_KWH
+        self.capacity_by_devid = {}  # devid -> capacity set in the options flow
+        self.update_from_entry(entry)
+
+    def update_from_entry(self, entry):
+        """Apply the user-configured capacities and scan interval from the config entry."""
+        suffix = "_capacity_kwh"
+        default_capacity_kwh = entry.data.get("default_capacity_kwh", DEFAULT_CAPACITY_KWH)
+        capacity_by_devid = {
+            key[:-len(suffix)]: value
+            for key, value in entry.options.items()
+            if key.endswith(suffix)
+        }
+        scan_interval = entry.options.get(
+            "scan_interval",
+            entry.data.get("scan_interval", self.update_interval.total_seconds())
+        )
+        self.update_interval = timedelta(seconds=scan_interval)
+
+        changed = (
+            default_capacity_kwh != self.default_capacity_kwh
+            or capacity_by_devid != self.capacity_by_devid
+        )
+        self.default_capacity_kwh = default_capacity_kwh
+        self.capacity_by_devid = capacity_by_devid
+        # Show new capacities right away instead of waiting for the next poll
+        if changed and self.data:
+            self._compute_derived(self.data)
+            self.async_update_listeners()
+
+    def stored_devices(self):
+        """Return the current devices without derived keys, for saving in the config entry."""
+        return [
+            {key: value for key, value in d.items() if not key.startswith("_")}
+            for d in self.data or []
+        ]
+
+    def _compute_derived(self, devices):
+        """Compute per-device charge, the lookup index and the cross-device totals in one pass."""
+        devices_by_id = {}
+        total_charge = 0.0
+        total_power = 0
+        for d in devices:
+            capacity_kwh = self.capacity_by_devid.get(d["devid"], self.default_capacity_kwh)
+            d["_charge_kwh"] = round((d.get("soc") or 0) / 100.0 * capacity_kwh, 2)
+            devices_by_id[d["devid"]] = d
+            total_charge += d["_charge_kwh"]
+            total_power += (d.get("charge") or 0) - (d.get("discharge") or 0)
+
+        self.devices_by_id = devices_by_id
+        self.total_charge_kwh = round(total_charge, 2)
+        self.total_power_w = round(total_power, 2)
 
     async def _async_update_data(self):
         start = time.perf_counter()
         devices = await self.api.get_devices()
         self.last_latency = round((time.perf_counter() - start) * 1000, 1)
+        self.last_update_time = dt_util.utcnow()
+
+        self._compute_derived(devices)
         
         # Debug: Log the processed device data
         _LOGGER.debug("Marstek processed device data: %s", devices)
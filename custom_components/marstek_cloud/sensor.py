@@ -1,5 +1,4 @@
-from datetime import datetime
-from homeassistant.components.sensor import SensorEntity
+from homeassistant.components.sensor import SensorDeviceClass, SensorEntity
 from homeassistant.const import (
     PERCENTAGE,
     UnitOfPower,
@@ -7,7 +6,11 @@ from homeassistant.const import (
     UnitOfEnergy,
     CURRENCY_EURO,
 )
-from .const import DOMAIN, DEFAULT_CAPACITY_KWH
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.device_registry import DeviceEntryType
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+from .const import DOMAIN
 import logging
 
 # Main battery data sensors
@@ -24,7 +27,7 @@ SENSOR_TYPES = {
 
 # Diagnostic sensors for integration health
 DIAGNOSTIC_SENSORS = {
-    "last_update": {"name": "Last Update", "unit": None},
+    "last_update": {"name": "Last Update", "unit": None, "device_class": SensorDeviceClass.TIMESTAMP},
     "api_latency": {"name": "API Latency", "unit": "ms"},
     "connection_status": {"name": "Connection Status", "unit": None},
 }
@@ -32,11 +35,20 @@ DIAGNOSTIC_SENSORS = {
 _LOGGER = logging.getLogger(__name__)
 
 
-async def async_setup_entry(hass, entry, async_add_entities):
-    """Set up Marstek sensors from a config entry."""
-    coordinator = hass.data[DOMAIN][entry.entry_id]
+def _integration_device_info(entry_id):
+    """Return the device that groups the integration-wide sensors of an entry."""
+    return {
+        "identifiers": {(DOMAIN, entry_id)},
+        "name": "Marstek Cloud Integration",
+        "manufacturer": "Marstek",
+        "entry_type": DeviceEntryType.SERVICE,
+    }
+
+
+def _device_entities(hass, coordinator, entry_id, existing_entities):
+    """Create the per-device and cross-device sensors for the current data."""
     entities = []
-    existing_entities = hass.states.async_entity_ids()  # Get existing entity IDs
+    entity_registry = er.async_get(hass)
 
     for device in coordinator.data:
         # Add main battery data sensors
@@ -45,11 +57,11 @@ async def async_setup_entry(hass, entry, async_add_entities):
             if unique_id not in existing_entities:  # Check if entity already exists
                 entities.append(MarstekSensor(coordinator, device, key, meta))
 
-        # Add diagnostic sensors
-        for key, meta in DIAGNOSTIC_SENSORS.items():
-            unique_id = f"{device['devid']}_{key}"
-            if unique_id not in existing_entities:  # Check if entity already exists
-                entities.append(MarstekDiagnosticSensor(coordinator, device, key, meta))
+        # Remove diagnostic sensors left over from when they were created per device
+        for key in DIAGNOSTIC_SENSORS:
+            entity_id = entity_registry.async_get_entity_id("sensor", DOMAIN, f"{device['devid']}_{key}")
+            if entity_id is not None:
+                entity_registry.async_remove(entity_id)
 
         # Add total charge per device sensor
         unique_id = f"{device['devid']}_total_charge"
@@ -57,40 +69,74 @@ async def async_setup_entry(hass, entry, async_add_entities):
             entities.append(MarstekDeviceTotalChargeSensor(coordinator, device, "total_charge", {"name": "Total Charge", "unit": UnitOfEnergy.KILO_WATT_HOUR}))
 
     # Add total charge across all devices sensor
-    unique_id = f"total_charge_all_devices_{entry.entry_id}"
+    unique_id = f"total_charge_all_devices_{entry_id}"
     if unique_id not in existing_entities:  # Check if entity already exists
-        entities.append(MarstekTotalChargeSensor(coordinator, entry.entry_id))
+        entities.append(MarstekTotalChargeSensor(coordinator, entry_id))
 
     # Add total power across all devices sensor
-    unique_id = f"total_power_all_devices_{entry.entry_id}"
+    unique_id = f"total_power_all_devices_{entry_id}"
     if unique_id not in existing_entities:  # Check if entity already exists
-        entities.append(MarstekTotalPowerSensor(coordinator, entry.entry_id))
+        entities.append(MarstekTotalPowerSensor(coordinator, entry_id))
+
+    return entities
+
+
+async def async_setup_entry(hass, entry, async_add_entities):
+    """Set up Marstek sensors from a config entry."""
+    coordinator = hass.data[DOMAIN][entry.entry_id]
+    entities = []
+    existing_entities = hass.states.async_entity_ids()  # Get existing entity IDs
+
+    # Add diagnostic sensors, once for the whole integration
+    for key, meta in DIAGNOSTIC_SENSORS.items():
+        unique_id = f"{entry.entry_id}_{key}"
+        if unique_id not in existing_entities:  # Check if entity already exists
+            entities.append(MarstekIntegrationDiagnosticSensor(coordinator, entry.entry_id, key, meta))
+
+    if coordinator.data:
+        entities.extend(_device_entities(hass, coordinator, entry.entry_id, existing_entities))
+    else:
+        # No devices yet: add the device sensors once a poll returns some
+        @callback
+        def _late_add():
+            if not coordinator.data:
+                return
+            _remove_late_add()
+            hass.config_entries.async_update_entry(entry, data={**entry.data, "devices": coordinator.stored_devices()})
+            async_add_entities(_device_entities(hass, coordinator, entry.entry_id, hass.states.async_entity_ids()))
+
+        @callback
+        def _remove_late_add():
+            nonlocal remove_listener
+            if remove_listener is not None:
+                remove_listener()
+                remove_listener = None
+
+        remove_listener = coordinator.async_add_listener(_late_add)
+        entry.async_on_unload(_remove_late_add)
 
     async_add_entities(entities)
 
 
-class MarstekBaseSensor(SensorEntity):
+class MarstekBaseSensor(CoordinatorEntity, SensorEntity):
     """Base class for Marstek sensors with shared device info."""
 
     def __init__(self, coordinator, device, key, meta):
-        self.coordinator = coordinator
+        super().__init__(coordinator)
         self.devid = device["devid"]
-        self.device_data = device
         self.key = key
         self._attr_name = f"{device['name']} {meta['name']}"
         self._attr_unique_id = f"{self.devid}_{self.key}"  # Ensure unique ID includes device ID and sensor key
         self._attr_native_unit_of_measurement = meta["unit"]
-
-    @property
-    def device_info(self):
-        """Return metadata for the device registry."""
-        return {
+        self._attr_device_class = meta.get("device_class")
+        # Metadata for the device registry, fixed for the lifetime of the entity
+        self._attr_device_info = {
             "identifiers": {(DOMAIN, self.devid)},
-            "name": self.device_data["name"],
+            "name": device["name"],
             "manufacturer": "Marstek",
-            "model": self.device_data.get("type", "Unknown"),
-            "sw_version": str(self.device_data.get("version", "")),
-            "serial_number": self.device_data.get("sn", ""),
+            "model": device.get("type", "Unknown"),
+            "sw_version": str(device.get("version", "")),
+            "serial_number": device.get("sn", ""),
         }
 
 
@@ -100,26 +146,34 @@ class MarstekSensor(MarstekBaseSensor):
     @property
     def native_value(self):
         """Return the current value of the sensor."""
-        for dev in self.coordinator.data:
-            if dev["devid"] == self.devid:
-                return dev.get(self.key)
-        return None
+        dev = self.coordinator.devices_by_id.get(self.devid)
+        if dev is None:
+            return None
+        return dev.get(self.key)
 
-    async def async_update(self):
-        """Manually trigger an update."""
-        await self.coordinator.async_request_refresh()
 
+class MarstekIntegrationDiagnosticSensor(CoordinatorEntity, SensorEntity):
+    """Sensor for integration diagnostics, shared by all devices of an entry."""
 
-class MarstekDiagnosticSensor(MarstekBaseSensor):
-    """Sensor for integration diagnostics."""
+    def __init__(self, coordinator, entry_id, key, meta):
+        super().__init__(coordinator)
+        self.key = key
+        self._attr_name = f"Marstek Cloud {meta['name']}"
+        self._attr_unique_id = f"{entry_id}_{key}"
+        self._attr_native_unit_of_measurement = meta["unit"]
+        self._attr_device_class = meta.get("device_class")
+        self._attr_device_info = _integration_device_info(entry_id)
+
+    @property
+    def available(self):
+        """Stay available so failed updates are reported, not hidden."""
+        return True
 
     @property
     def native_value(self):
         """Return the diagnostic value."""
         if self.key == "last_update":
-            if self.coordinator.last_update_success:
-                return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            return None
+            return self.coordinator.last_update_time
 
         elif self.key == "api_latency":
             return getattr(self.coordinator, "last_latency", None)
@@ -130,73 +184,74 @@ class MarstekDiagnosticSensor(MarstekBaseSensor):
         return None
 
 
-class MarstekTotalChargeSensor(SensorEntity):
+class MarstekTotalChargeSensor(CoordinatorEntity, SensorEntity):
     """Sensor to calculate the total charge across all devices."""
 
     def __init__(self, coordinator, entry_id):
-        self.coordinator = coordinator
+        super().__init__(coordinator)
         self._attr_name = "Total Charge Across Devices"
         # Use entry_id for a stable unique ID
         self._attr_unique_id = f"total_charge_all_devices_{entry_id}"
+        self._attr_device_info = _integration_device_info(entry_id)
         self._attr_native_unit_of_measurement = UnitOfEnergy.KILO_WATT_HOUR
+        self._attr_extra_state_attributes = {"device_count": len(coordinator.data)}
 
     @property
     def native_value(self):
         """Return the total charge across all devices."""
-        total_charge = 0
-        for device in self.coordinator.data:
-            soc = device.get("soc", 0)
-            capacity_kwh = device.get("capacity_kwh", DEFAULT_CAPACITY_KWH)
-            total_charge += (soc / 100) * capacity_kwh
-        return round(total_charge, 2)
+        return self.coordinator.total_charge_kwh
 
-    @property
-    def extra_state_attributes(self):
-        return {
-            "device_count": len(self.coordinator.data),
-        }
+    @callback
+    def _handle_coordinator_update(self):
+        """Refresh the device count before writing the new state."""
+        self._attr_extra_state_attributes["device_count"] = len(self.coordinator.data)
+        super()._handle_coordinator_update()
 
 
-class MarstekTotalPowerSensor(SensorEntity):
+class MarstekTotalPowerSensor(CoordinatorEntity, SensorEntity):
     """Sensor to calculate the total charge and discharge power across all devices."""
 
     def __init__(self, coordinator, entry_id):
-        self.coordinator = coordinator
+        super().__init__(coordinator)
         self._attr_name = "Total Power Across Devices"
         # Use entry_id for a stable unique ID
         self._attr_unique_id = f"total_power_all_devices_{entry_id}"
+        self._attr_device_info = _integration_device_info(entry_id)
         self._attr_native_unit_of_measurement = UnitOfPower.WATT
+        self._attr_extra_state_attributes = {"device_count": len(coordinator.data)}
 
     @property
     def native_value(self):
         """Return the total power (charge - discharge) across all devices."""
-        total_power = 0
-        for device in self.coordinator.data:
-            charge_power = device.get("charge", 0)
-            discharge_power = device.get("discharge", 0)
-            total_power += charge_power - discharge_power
-        return round(total_power, 2)
+        return self.coordinator.total_power_w
 
-    @property
-    def extra_state_attributes(self):
-        return {
-            "device_count": len(self.coordinator.data),
-        }
+    @callback
+    def _handle_coordinator_update(self):
+        """Refresh the device count before writing the new state."""
+        self._attr_extra_state_attributes["device_count"] = len(self.coordinator.data)
+        super()._handle_coordinator_update()
 
 
 class MarstekDeviceTotalChargeSensor(MarstekBaseSensor):
     """Sensor to calculate the total charge for a specific device."""
 
+    def __init__(self, coordinator, device, key, meta):
+        super().__init__(coordinator, device, key, meta)
+        self._attr_extra_state_attributes = {
+            "device_name": device.get("name"),
+            "capacity_kwh": coordinator.capacity_by_devid.get(self.devid, coordinator.default_capacity_kwh),
+        }
+
     @property
     def native_value(self):
         """Return the total charge for the device."""
-        soc = self.device_data.get("soc", 0)
-        capacity_kwh = self.device_data.get("capacity_kwh", DEFAULT_CAPACITY_KWH)
-        return round((soc / 100) * capacity_kwh, 2)
+        dev = self.coordinator.devices_by_id.get(self.devid)
+        if dev is None:
+            return None
+        return dev["_charge_kwh"]
 
-    @property
-    def extra_state_attributes(self):
-        return {
-            "device_name": self.device_data.get("name"),
-            "capacity_kwh": self.device_data.get("capacity_kwh", DEFAULT_CAPACITY_KWH),
-        }
+    @callback
+    def _handle_coordinator_update(self):
+        """Pick up capacity changes made in the options flow."""
+        self._attr_extra_state_attributes["capacity_kwh"] = self.coordinator.capacity_by_devid.get(self.devid, self.coordinator.default_capacity_kwh)
+        super()._handle_coordinator_update()